@@ -1,68 +1,267 @@
 #!/usr/bin/env python3
+import concurrent.futures
+import functools
+import hashlib
 import json
 import os
 import re
 import requests
+import shlex
 import subprocess
 import sys
+import threading
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # semantic cache lookups degrade to exact match only
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads  # slower stream parsing, same behaviour
 
 # ------------------------
 # Utility: Determine distro and broad family
 # ------------------------
-def get_distro_and_family():
-    distro = "unknown"
+@functools.lru_cache(maxsize=1)
+def get_os_release():
+    """Parse /etc/os-release into a dict (parsed once, cached thereafter)."""
     try:
-        with open("/etc/os-release") as f:
-            for line in f:
-                if line.startswith("ID="):
-                    distro = line.split("=")[1].strip().strip('"').lower()
-                    break
+        text = Path("/etc/os-release").read_text()
     except Exception as e:
         print("Couldn't determine distro:", e)
-    # Map specific distro IDs to broad families.
-    if distro in ["ubuntu", "debian", "mint", "elementary", "pop"]:
-        family = "Ubuntu/Debian-based"
-    elif distro in ["endeavouros", "arch", "manjaro"]:
-        family = "Arch-based"
-    elif distro in ["fedora", "centos", "rhel"]:
-        family = "Fedora/RHEL-based"
-    else:
-        family = distro
+        return {}
+    return {
+        key: value.strip('"').strip("'")
+        for key, _, value in (
+            line.rstrip().partition("=")
+            for line in text.splitlines()
+            if "=" in line and not line.startswith("#")
+        )
+    }
+
+def get_distro_and_family():
+    os_release = get_os_release()
+    distro = os_release.get("ID", "unknown").lower()
+    # ID_LIKE lists parent distros (e.g. Rocky -> "rhel centos fedora"), so
+    # derivatives we don't know by name still land in the right family.
+    candidates = [distro] + os_release.get("ID_LIKE", "").lower().split()
+    family = distro
+    for candidate in candidates:
+        if candidate in ("ubuntu", "debian", "mint", "elementary", "pop"):
+            family = "Ubuntu/Debian-based"
+            break
+        elif candidate in ("endeavouros", "arch", "manjaro"):
+            family = "Arch-based"
+            break
+        elif candidate in ("fedora", "centos", "rhel"):
+            family = "Fedora/RHEL-based"
+            break
     return distro, family
 
 # ------------------------
 # Check that a command is appropriate for the distro family (only for package management commands)
 # ------------------------
+_PM_KEYWORDS = frozenset({"apt", "apt-get", "dpkg", "pacman", "dnf", "yum"})
+_EXPECTED_PM = {
+    "Ubuntu/Debian-based": frozenset({"apt", "apt-get", "dpkg"}),
+    "Arch-based": frozenset({"pacman"}),
+    "Fedora/RHEL-based": frozenset({"dnf", "yum"}),
+}
+_TOKEN_RE = re.compile(r"[a-z0-9_-]+")
+
+# Human-readable label for the family's package manager, used in mismatch prompts.
+_EXPECTED_LABEL = {
+    "Ubuntu/Debian-based": "apt/dpkg",
+    "Arch-based": "pacman",
+    "Fedora/RHEL-based": "dnf/yum",
+}
+
+@functools.lru_cache(maxsize=256)
 def is_command_for_distro(cmd, family):
     """
     If the command contains any package management keywords (apt, pacman, etc.), then
     ensure that it matches the expected package manager for the detected broad family.
-    Otherwise, accept the command as generic.
+    Otherwise, accept the command as generic. Memoized: the same candidates
+    recur across clarification iterations and the retry-with-sudo path.
     """
-    cmd_lower = cmd.lower()
-    pm_keywords = ["apt", "apt-get", "dpkg", "pacman", "dnf", "yum"]
-    expected_pm = {
-         "Ubuntu/Debian-based": ["apt", "apt-get", "dpkg"],
-         "Arch-based": ["pacman"],
-         "Fedora/RHEL-based": ["dnf", "yum"],
-    }
-    if any(keyword in cmd_lower for keyword in pm_keywords):
-         if family in expected_pm:
-             if any(keyword in cmd_lower for keyword in expected_pm[family]):
-                  return True
-             else:
-                  return False
-         else:
-             return True
-    else:
-         return True
+    tokens = set(_TOKEN_RE.findall(cmd.lower()))
+    hits = tokens & _PM_KEYWORDS
+    if not hits:
+        return True
+    expected = _EXPECTED_PM.get(family)
+    return expected is None or bool(hits & expected)
+
+# ------------------------
+# Persistent cache: instruction -> validated command (skips the Ollama round-trip)
+# ------------------------
+CACHE_DIR = os.path.expanduser("~/.llama-term")
+CACHE_FILE = os.path.join(CACHE_DIR, "cache.json")
+CACHE_EMB_FILE = os.path.join(CACHE_DIR, "cache_embeddings.npy")
+SIMILARITY_THRESHOLD = 0.92
+
+class CommandCache:
+    """
+    On-disk cache mapping (family, user instruction) to the last command that
+    was validated and executed successfully. Lookups try an exact match first,
+    then (if NumPy and the Ollama embeddings endpoint are available) fall back
+    to nearest-neighbour search over instruction embeddings so paraphrased
+    requests ("list files" vs "show files in dir") still hit the cache.
+    """
+    def __init__(self, path=CACHE_FILE, emb_path=CACHE_EMB_FILE, enabled=True):
+        self.path = path
+        self.emb_path = emb_path
+        self.enabled = enabled
+        self.entries = {}
+        self.emb_keys = []   # row i of the embedding matrix belongs to emb_keys[i]
+        self.emb_matrix = None
+        self._last_hit_key = None  # key of the entry the last get() served
+        if self.enabled:
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                if "commands" in data:
+                    self.entries = data["commands"]
+                    self.emb_keys = data.get("embedding_keys", [])
+                else:
+                    # Older flat-dict cache files: keep the commands, no embeddings.
+                    self.entries = data
+            except Exception:
+                self.entries = {}
+            if np is not None and self.emb_keys:
+                try:
+                    self.emb_matrix = np.load(self.emb_path).astype(np.float32)
+                    if self.emb_matrix.shape[0] != len(self.emb_keys):
+                        raise ValueError("embedding matrix out of sync with cache.json")
+                except Exception:
+                    self.emb_keys = []
+                    self.emb_matrix = None
+
+    @staticmethod
+    def make_key(family, user_instruction):
+        raw = family + "\0" + user_instruction.strip().lower()
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, family, user_instruction):
+        if not self.enabled:
+            return None
+        self._last_hit_key = None
+        key = self.make_key(family, user_instruction)
+        exact = self.entries.get(key)
+        if exact is not None:
+            self._last_hit_key = key
+            return exact
+        return self._semantic_get(family, user_instruction)
+
+    def _semantic_get(self, family, user_instruction):
+        if np is None or self.emb_matrix is None or self.emb_matrix.shape[0] == 0:
+            return None
+        # Restrict the search to this family's rows up front, so a high-scoring
+        # entry from another family can't shadow a valid same-family hit.
+        prefix = family + "\0"
+        rows = [i for i, key in enumerate(self.emb_keys) if key.startswith(prefix)]
+        if not rows:
+            return None
+        embedding = query_embedding(user_instruction)
+        if embedding is None:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        matrix = self.emb_matrix[rows]
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        norms[norms == 0] = 1.0
+        sims = (matrix @ query) / norms
+        best = int(np.argmax(sims))
+        if sims[best] > SIMILARITY_THRESHOLD:
+            key = self.emb_keys[rows[best]].split("\0", 1)[1]
+            command = self.entries.get(key)
+            if command is not None:
+                # Remember which entry hit, so invalidate() removes the right
+                # one (the current instruction hashes to a different key).
+                self._last_hit_key = key
+            return command
+        return None
+
+    def put(self, family, user_instruction, command):
+        if not self.enabled:
+            return
+        key = self.make_key(family, user_instruction)
+        self.entries[key] = command
+        if np is not None:
+            embedding = query_embedding(user_instruction)
+            if embedding is not None:
+                row = np.asarray([embedding], dtype=np.float32)
+                emb_key = family + "\0" + key
+                if emb_key not in self.emb_keys:
+                    self.emb_keys.append(emb_key)
+                    if self.emb_matrix is None:
+                        self.emb_matrix = row
+                    else:
+                        self.emb_matrix = np.vstack([self.emb_matrix, row])
+        self._save()
+
+    def invalidate(self, family, user_instruction):
+        if not self.enabled:
+            return
+        # A semantic hit served an entry stored under another instruction's
+        # key; drop that entry, not the hash of the current instruction.
+        key = self._last_hit_key or self.make_key(family, user_instruction)
+        self._last_hit_key = None
+        self.entries.pop(key, None)
+        emb_key = family + "\0" + key
+        if emb_key in self.emb_keys and self.emb_matrix is not None:
+            idx = self.emb_keys.index(emb_key)
+            self.emb_keys.pop(idx)
+            self.emb_matrix = np.delete(self.emb_matrix, idx, axis=0)
+        self._save()
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump({"commands": self.entries, "embedding_keys": self.emb_keys}, f)
+            if np is not None and self.emb_matrix is not None:
+                np.save(self.emb_path, self.emb_matrix)
+        except Exception as e:
+            print("Couldn't save command cache:", e)
 
 # ------------------------
 # Configuration for Ollama
 # ------------------------
 OLLAMA_HOST = "10.0.0.100"
 OLLAMA_PORT = 11434  # adjust if needed
-OLLAMA_URL = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}/api/generate"
+OLLAMA_URL = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}/api/chat"
+OLLAMA_EMBED_URL = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}/api/embeddings"
+EMBED_MODEL = "nomic-embed-text"
+
+# One session for every Ollama call: keeps the TCP connection alive across
+# the clarification loop instead of re-handshaking per request.
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                                     max_retries=Retry(total=2, backoff_factor=0.2)))
+# (connect, read) timeouts: fail fast on a dead host, allow slow generation.
+REQUEST_TIMEOUT = (3, 60)
+
+# Keep the model resident between user turns so follow-up queries skip reload.
+KEEP_ALIVE = "30m"
+
+def prewarm_model():
+    """
+    Load llama3.2 on the Ollama host without generating anything, so the
+    first real query doesn't pay the model's cold-start latency. Fired in a
+    daemon thread from main(); failures are ignored (the first query will
+    just be slower).
+    """
+    try:
+        SESSION.post(OLLAMA_URL,
+                     json={"model": "llama3.2", "messages": [], "keep_alive": KEEP_ALIVE},
+                     timeout=REQUEST_TIMEOUT)
+    except Exception:
+        pass
 
 # ------------------------
 # Base prompt instructions
@@ -75,57 +274,175 @@ BASE_PROMPT = (
 )
 
 # ------------------------
-# Build the conversation prompt (includes the broad distro family)
+# Build the chat messages list (includes the broad distro family)
+# ------------------------
+def build_messages(conversation_history, family):
+    """
+    Prepend the system message to the conversation history (already a list of
+    {"role": ..., "content": ...} dicts). Sending the incremental list
+    (instead of one rebuilt prompt string) lets the server reuse its KV cache
+    across turns, so each iteration only pays prefill for the new tokens.
+    """
+    system = {
+        "role": "system",
+        "content": BASE_PROMPT + f"\nSystem distribution: {family}"
+    }
+    return [system] + conversation_history
+
+# ------------------------
+# Bound the history so prefill cost can't grow without limit
 # ------------------------
-def build_prompt(conversation_history, family):
-    prompt = BASE_PROMPT + "\n"
-    prompt += f"System distribution: {family}\n"
-    for entry in conversation_history:
-        prompt += entry + "\n"
-    return prompt
+MAX_HISTORY_ENTRIES = 13  # original instruction + the last 6 exchange pairs
+
+def trim_history(conversation_history):
+    """
+    Keep the original instruction (always) plus the most recent turns. If the
+    server evicts its KV cache, prefill cost is then bounded by this window
+    instead of scaling with the whole conversation.
+    """
+    if len(conversation_history) > MAX_HISTORY_ENTRIES:
+        return [conversation_history[0]] + conversation_history[-(MAX_HISTORY_ENTRIES - 1):]
+    return conversation_history
 
 # ------------------------
 # Query Ollama (with streaming JSON lines)
 # ------------------------
-def query_ollama(prompt):
+def query_ollama(messages, seed=None, cancel_event=None):
+    """
+    Stream one chat completion and classify it on the fly. Returns a
+    (tag, candidate, text) tuple where tag is "command" (candidate holds the
+    extracted command), "question" (response ends with "?") or "junk", or
+    None on a transport error. Classifying during the read means callers
+    never re-scan the response text. If cancel_event is set while streaming
+    (another sample already won), the response is closed and None returned.
+    """
+    options = {
+        "num_predict": 150,
+        "temperature": 0.7
+    }
+    if seed is not None:
+        options["seed"] = seed
     payload = {
         "model": "llama3.2",
-        "prompt": prompt,
-        "parameters": {
-            "max_tokens": 150,
-            "temperature": 0.7
-        }
+        "messages": messages,
+        "keep_alive": KEEP_ALIVE,
+        "options": options
     }
     try:
-        response = requests.post(OLLAMA_URL, json=payload, stream=True)
+        response = SESSION.post(OLLAMA_URL, json=payload, stream=True, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        output_parts = []
-        for line in response.iter_lines(decode_unicode=True):
+        buffer = ""
+        # Raw bytes feed orjson's fast path and skip a per-chunk UTF-8 decode.
+        for line in response.iter_lines(decode_unicode=False):
+            if cancel_event is not None and cancel_event.is_set():
+                response.close()
+                return None
             if line:
                 try:
-                    data = json.loads(line)
-                    output_parts.append(data.get("response", ""))
+                    data = _json_loads(line)
+                    chunk = data.get("message", {}).get("content", "")
+                    if chunk:
+                        buffer += chunk
+                        # A complete `command` pair means the rest of the
+                        # generation is prose we don't need; stop reading.
+                        match = _BACKTICK_RE.search(buffer)
+                        if match and is_valid_command(match.group(1).strip()):
+                            response.close()
+                            return ("command", match.group(1).strip(), buffer.strip())
                     if data.get("done", False):
                         break
-                except json.JSONDecodeError as je:
+                except ValueError as je:
                     print(f"JSON decode error: {je}")
                     continue
-        return ''.join(output_parts).strip()
+        # Stream drained without an early exit: classify what we got. The
+        # extraction here covers fenced/truncated responses the inline
+        # backtick check can't accept.
+        text = buffer.strip()
+        candidate = extract_command(text)
+        if candidate and is_valid_command(candidate):
+            return ("command", candidate, text)
+        if text.endswith("?"):
+            return ("question", None, text)
+        return ("junk", None, text)
     except Exception as e:
         print(f"Error communicating with Ollama: {e}")
         return None
 
+# ------------------------
+# Query Ollama for several candidate responses at once
+# ------------------------
+NUM_CANDIDATES = 3
+
+def query_ollama_candidates(messages, family, n=NUM_CANDIDATES):
+    """
+    Fire n sampling requests with different seeds in parallel and return the
+    first classified (tag, candidate, text) result whose command also matches
+    the distro family. Once a winner is found, a shared event tells the
+    losing workers to close their streams rather than drain them. If no
+    sample qualifies, return the most useful completed result by tag
+    (command > question > junk) so a fast junk sample can't shadow a
+    clarifying question. Trades extra server-side compute for lower tail
+    latency when the first sample is invalid.
+    """
+    cancel_event = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=n)
+    futures = [executor.submit(query_ollama, messages, seed, cancel_event)
+               for seed in range(n)]
+    tag_rank = {"command": 0, "question": 1, "junk": 2}
+    fallback = None
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if result is None:
+                continue
+            tag, candidate, _ = result
+            if tag == "command" and is_command_for_distro(candidate, family):
+                return result
+            if fallback is None or tag_rank[tag] < tag_rank[fallback[0]]:
+                fallback = result
+        return fallback
+    finally:
+        # Stop the losing streams (no-op if everything already finished).
+        cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# ------------------------
+# Query Ollama for a text embedding (used by the semantic cache)
+# ------------------------
+def query_embedding(text):
+    payload = {
+        "model": EMBED_MODEL,
+        "prompt": text
+    }
+    try:
+        response = SESSION.post(OLLAMA_EMBED_URL, json=payload, timeout=10)
+        response.raise_for_status()
+        return response.json().get("embedding")
+    except Exception:
+        # Embeddings are best-effort; the caller falls back to exact matching.
+        return None
+
 # ------------------------
 # Extract a command from the LLM response
 # ------------------------
+_FENCE_RE = re.compile(r'```([\s\S]+?)```')
+_BACKTICK_RE = re.compile(r'`([^`]+)`')
+# An opened-but-unclosed fence (stream stopped mid-block), optional language tag.
+_LOOSE_FENCE_RE = re.compile(r'```(?:[a-z]*\n)?([^\n`]+)')
+
+@functools.lru_cache(maxsize=256)
 def extract_command(response_text):
     """
+    Pure function, memoized: retries in the clarification loop often re-run
+    extraction on an identical response.
     Look for a command enclosed in backticks or in triple-backtick code blocks.
+    The fence pattern is tried first since fenced blocks contain single
+    backticks. As a last resort, accept a fence that was never closed so a
+    truncated response doesn't cost another LLM round-trip.
     """
-    match = re.search(r'`([^`]+)`', response_text)
-    if match:
-        return match.group(1).strip()
-    match = re.search(r'```([\s\S]+?)```', response_text)
+    match = (_FENCE_RE.search(response_text)
+             or _BACKTICK_RE.search(response_text)
+             or _LOOSE_FENCE_RE.search(response_text))
     if match:
         return match.group(1).strip()
     return ""
@@ -133,17 +450,17 @@ def extract_command(response_text):
 # ------------------------
 # Check for a valid command line command (generic heuristics)
 # ------------------------
+_STARTER_RE = re.compile(r"^(?:it |i'm|hello|hi|sure|ok|yes)\b", re.IGNORECASE)
+
 def is_valid_command(cmd):
     cmd = cmd.strip()
     if not cmd:
         return False
     if "\n" in cmd:
         return False
+    if _STARTER_RE.match(cmd):
+        return False
     lower = cmd.lower()
-    conversation_starters = ("it ", "i'm", "hello", "hi", "sure", "ok", "yes")
-    for starter in conversation_starters:
-        if lower.startswith(starter):
-            return False
     if "command:" in lower or "output:" in lower:
         return False
     return True
@@ -151,12 +468,33 @@ def is_valid_command(cmd):
 # ------------------------
 # Execute a shell command interactively (streams output to terminal)
 # ------------------------
+# Characters that require a shell to interpret (pipes, redirects, globs, ...).
+_SHELL_METACHARS = set("|&;<>()$`\\\"'*?[#~=%")
+
 def execute_command(command):
     """
     Execute the command interactively, streaming output to the terminal.
     This lets you interact with the process if it prompts for input.
+    Simple commands skip the intermediate /bin/sh; anything containing
+    shell metacharacters falls back to shell=True.
     """
     try:
+        if not set(command) & _SHELL_METACHARS:
+            try:
+                argv = shlex.split(command)
+            except ValueError:
+                argv = None
+            if argv:
+                try:
+                    result = subprocess.run(argv, shell=False)
+                    return result.returncode, None, None
+                except FileNotFoundError:
+                    # Match what /bin/sh would have told the user.
+                    print(f"{argv[0]}: command not found")
+                    return 127, None, None
+                except PermissionError:
+                    print(f"{argv[0]}: permission denied")
+                    return 126, None, None
         result = subprocess.run(command, shell=True)
         return result.returncode, None, None
     except Exception as e:
@@ -167,8 +505,11 @@ def execute_command(command):
 # ------------------------
 def main():
     distro, family = get_distro_and_family()
+    expected_label = _EXPECTED_LABEL.get(family, "the distro's package manager")
+    cache = CommandCache(enabled="--disable-cache" not in sys.argv)
     print(f"Detected system distribution: {distro} ({family})")
     print("Interactive LLM Command Runner. Type 'exit' to quit.")
+    threading.Thread(target=prewarm_model, daemon=True).start()
 
     while True:
         user_instruction = input("\nDescribe what you want to accomplish:\n> ").strip()
@@ -177,28 +518,29 @@ def main():
             break
 
         conversation_history = []
-        conversation_history.append("User: " + user_instruction)
-        final_command = None
+        conversation_history.append({"role": "user", "content": user_instruction})
+        final_command = cache.get(family, user_instruction)
+        from_cache = final_command is not None
+        if from_cache:
+            print("(cached)")
         iteration = 0
         max_iterations = 5
 
-        while iteration < max_iterations:
-            prompt = build_prompt(conversation_history, family)
+        while final_command is None and iteration < max_iterations:
+            conversation_history = trim_history(conversation_history)
+            messages = build_messages(conversation_history, family)
             print("\nQuerying LLM for a command suggestion...")
-            llm_response = query_ollama(prompt)
-            if not llm_response:
+            result = query_ollama_candidates(messages, family)
+            if result is None:
                 print("No response received. Aborting this request.")
                 break
 
-            candidate = extract_command(llm_response)
-            if candidate and is_valid_command(candidate):
+            tag, candidate, llm_response = result
+            if tag == "command":
                 if not is_command_for_distro(candidate, family):
-                    expected = ("apt/dpkg" if family == "Ubuntu/Debian-based"
-                                else ("dnf/yum" if family == "Fedora/RHEL-based"
-                                      else "the distro's package manager"))
-                    print("LLM returned a command that appears to be a package management command not matching your distro family.")
-                    print(f"Received: {candidate}")
-                    print(f"Expected a command using {expected} if a package manager is involved.")
+                    print("LLM returned a package management command not matching your distro family.\n"
+                          f"Received: {candidate}\n"
+                          f"Expected a command using {expected_label} if a package manager is involved.")
                     clarification = input("Your clarification (or type 'cancel' to abort): ").strip()
                     if clarification.lower() in ("cancel", "break", "exit", "quit"):
                         print("Clarification loop aborted.")
@@ -207,33 +549,32 @@ def main():
                     if not clarification:
                         print(f"No clarification provided. Please specify if this is a package management command or a generic one.")
                         continue
-                    conversation_history.append("Assistant (mismatch): " + llm_response)
-                    conversation_history.append("User: " + clarification)
+                    conversation_history.append({"role": "assistant", "content": llm_response})
+                    conversation_history.append({"role": "user", "content": clarification})
                     iteration += 1
                     continue
                 else:
                     final_command = candidate
-                    conversation_history.append("Assistant: " + llm_response)
+                    conversation_history.append({"role": "assistant", "content": llm_response})
                     break
-            else:
-                if llm_response.strip().endswith("?"):
-                    print("LLM asks:", llm_response)
-                    clarification = input("Your clarification (or type 'cancel' to abort): ").strip()
-                    if clarification.lower() in ("cancel", "break", "exit", "quit"):
-                        print("Clarification loop aborted.")
-                        final_command = None
-                        break
-                    if not clarification:
-                        print("No clarification provided. Please provide additional details.")
-                        continue
-                    conversation_history.append("Assistant: " + llm_response)
-                    conversation_history.append("User: " + clarification)
-                    iteration += 1
-                    continue
-                else:
-                    print("LLM did not return a valid command. Please try rephrasing your request.")
+            elif tag == "question":
+                print("LLM asks:", llm_response)
+                clarification = input("Your clarification (or type 'cancel' to abort): ").strip()
+                if clarification.lower() in ("cancel", "break", "exit", "quit"):
+                    print("Clarification loop aborted.")
                     final_command = None
                     break
+                if not clarification:
+                    print("No clarification provided. Please provide additional details.")
+                    continue
+                conversation_history.append({"role": "assistant", "content": llm_response})
+                conversation_history.append({"role": "user", "content": clarification})
+                iteration += 1
+                continue
+            else:
+                print("LLM did not return a valid command. Please try rephrasing your request.")
+                final_command = None
+                break
 
         if not final_command:
             print("No valid command generated. Starting over.")
@@ -246,6 +587,11 @@ def main():
         confirm = input("Execute this command? (Y/n): ").strip().lower()
         if confirm not in ("y", "yes", ""):
             print("Command skipped.")
+            if from_cache:
+                invalidate = input("Do you want to invalidate the cache? (y/n): ").strip().lower()
+                if invalidate in ("y", "yes"):
+                    cache.invalidate(family, user_instruction)
+                    print("Cache entry removed.")
             continue
 
         retcode, _, _ = execute_command(final_command)
@@ -281,5 +627,9 @@ def main():
         else:
             print("Command executed successfully.")
 
+        # Only remember commands that actually worked.
+        if retcode == 0:
+            cache.put(family, user_instruction, final_command)
+
 if __name__ == "__main__":
     main()